@@ -44,9 +44,9 @@ def cast_evs(evs):
 def get_subsampled_coordinates(evs, ds_h, ds_w):
     x_coords = evs[:, 1] // ds_w
     y_coords = evs[:, 2] // ds_h
-    if x_coords.dtype != np.int:
+    if x_coords.dtype != int:
         x_coords = x_coords.astype(int)
-    if y_coords.dtype != np.int:
+    if y_coords.dtype != int:
         y_coords = y_coords.astype(int)
     return x_coords, y_coords
 
@@ -95,49 +95,46 @@ def get_time_surface(evs, invtau=1e-6, size=(346, 260, 2)):
     return a
 
 
+def _event_time_bins(times, ts):
+    # per-event chunk id from the chunk boundaries, one searchsorted instead
+    # of a Python bisect per timestep; events past the last boundary drop out
+    bounds = np.searchsorted(times, ts)
+    n = bounds[-1] if len(bounds) else 0
+    return np.repeat(np.arange(len(ts)), np.diff(bounds, prepend=0)), n
+
+
 def chunk_evs_dvs(evs, deltat=1000, chunk_size=500, size=[304, 240], ds_w=1, ds_h=1):
     t_start = evs[0, 0]
-    ts = range(t_start + chunk_size, t_start + chunk_size * deltat, deltat)
+    ts = np.arange(t_start + chunk_size, t_start + chunk_size * deltat, deltat)
     chunks = np.zeros([len(ts)] + size, dtype='int8')
-    idx_start = 0
-    idx_end = 0
-    for i, t in enumerate(ts):
-        idx_end += find_first(evs[idx_end:, 0], t)
-        if idx_end > idx_start:
-            get_binary_frame_np(chunks[i, ...], evs[idx_start:idx_end], ds_h=ds_h, ds_w=ds_w)
-        idx_start = idx_end
+    tbin, n = _event_time_bins(evs[:, 0], ts)
+    ee = evs[:n]
+    x_coords, y_coords = get_subsampled_coordinates(ee, ds_h, ds_w)
+    chunks[tbin, x_coords, y_coords] = 2 * ee[:, 3] - 1
     return chunks
 
 def frame_evs(times, addrs, deltat=1000, duration=500, size=[240], downsample = [1]):
     t_start = times[0]
-    ts = range(t_start, t_start + duration * deltat, deltat)
+    ts = np.arange(t_start, t_start + duration * deltat, deltat)
     chunks = np.zeros([len(ts)] + size, dtype='int8')
-    idx_start = 0
-    idx_end = 0
-    for i, t in enumerate(ts):
-        idx_end += find_first(times[idx_end:], t)
-        if idx_end > idx_start:
-            ee = addrs[idx_start:idx_end]
-            ev = [(ee[:, i] // d).astype(np.int) for i,d in enumerate(downsample)]
-            np.add.at(chunks, tuple([i]+ev), 1)
-        idx_start = idx_end
+    tbin, n = _event_time_bins(times, ts)
+    ee = addrs[:n]
+    ev = [(ee[:, i] // d).astype(int) for i,d in enumerate(downsample)]
+    np.add.at(chunks, tuple([tbin]+ev), 1)
     return chunks
 
 
 def chunk_evs_pol_dvs(times, addrs, deltat=1000, chunk_size=500, size=[2, 304, 240], ds_w=1, ds_h=1):
     t_start = times[0]
-    ts = range(t_start, t_start + chunk_size * deltat, deltat)
+    ts = np.arange(t_start, t_start + chunk_size * deltat, deltat)
     chunks = np.zeros([len(ts)] + size, dtype='int8')
-    idx_start = 0
-    idx_end = 0
-    for i, t in enumerate(ts):
-        idx_end += find_first(times[idx_end:], t)
-        if idx_end > idx_start:
-            ee = addrs[idx_start:idx_end]
-            pol, x, y = ee[:, 2], (ee[:, 0] // ds_w).astype(np.int), (ee[:, 1] // ds_h).astype(np.int)
-            np.add.at(chunks, (i, pol, x, y), 1)
-        idx_start = idx_end
-    return chunks
+    tbin, n = _event_time_bins(times, ts)
+    ee = addrs[:n]
+    pol, x, y = ee[:, 2], (ee[:, 0] // ds_w).astype(int), (ee[:, 1] // ds_h).astype(int)
+    lin = ((tbin * size[0] + pol) * size[1] + x) * size[2] + y
+    counts = np.bincount(lin, minlength=chunks.size)
+    np.minimum(counts, 127, out=counts)
+    return counts.reshape(chunks.shape).astype(np.int8, copy=False)
 
 
 if __name__ == "__main__":